@@ -146,7 +146,7 @@ def test(data,
                 box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
                 for p, b in zip(pred.tolist(), box.tolist()):
                     jdict.append({'image_id': int(image_id) if image_id.isnumeric() else image_id,
-                                  'category_id': coco91class[int(p[5])],
+                                  'category_id': int(coco91class[int(p[5])]),
                                   'bbox': [round(x, 3) for x in b],
                                   'score': round(p[4], 5)})
 
@@ -2,28 +2,49 @@ import glob
 import math
 import os
 import random
+import re
 import shutil
 import subprocess
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from copy import copy
+from functools import lru_cache
 from pathlib import Path
 from sys import platform
+from typing import Optional
 
 import cv2
 import matplotlib
+matplotlib.use('Agg')  # non-interactive backend, figures are only ever saved to file
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
 import yaml
-from scipy.cluster.vq import kmeans
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
 from tqdm import tqdm
 
 from utils.torch_utils import init_seeds, is_parallel
 
+try:
+    from numba import njit, prange  # optional, accelerates kmean_anchors
+except ImportError:
+    njit = None
+
+try:
+    import pandas as pd  # optional, faster results*.txt parsing
+except ImportError:
+    pd = None
+
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml-backed
+except ImportError:
+    from yaml import SafeLoader
+
 # Set printoptions
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
@@ -31,6 +52,7 @@ matplotlib.rc('font', **{'size': 11})
 
 # Prevent OpenCV from multithreading (to use PyTorch DataLoader)
 cv2.setNumThreads(0)
+plt.ioff()
 
 
 @contextmanager
@@ -51,10 +73,21 @@ def init_seeds(seed=0):
     init_seeds(seed=seed)
 
 
+def _scan_last(d):
+    # Yields (ctime, path) for every 'last*.pt' below directory d, skipping hidden entries like glob does
+    with os.scandir(d) as it:
+        for e in it:
+            if e.name.startswith('.'):
+                continue
+            if e.is_dir():
+                yield from _scan_last(e.path)
+            elif e.name.startswith('last') and e.name.endswith('.pt'):
+                yield e.stat().st_ctime, e.path
+
+
 def get_latest_run(search_dir='./runs'):
     # Return path to most recent 'last.pt' in /runs (i.e. to --resume from)
-    last_list = glob.glob(f'{search_dir}/**/last*.pt', recursive=True)
-    return max(last_list, key=os.path.getctime)
+    return max(_scan_last(search_dir))[1]
 
 
 # 检测当前分支和git上面版本是否一致，如果版本落后则提醒用户
@@ -82,6 +115,7 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     shapes = imgsz * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     scale = np.random.uniform(0.9, 1.1, size=(shapes.shape[0], 1))  # augment scale
     wh = torch.tensor(np.concatenate([l[:, 3:5] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # wh
+    wh = wh.to(m.anchor_grid.device)  # compute the metric where the anchors live
 
     def metric(k):  # compute metric
         r = wh[:, None] / k[None]  # nx9x2
@@ -91,14 +125,14 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
         bpr = (best > 1. / thr).float().mean()  # best possible recall
         return bpr, aat
 
-    bpr, aat = metric(m.anchor_grid.clone().cpu().view(-1, 2))
+    bpr, aat = metric(m.anchor_grid.view(-1, 2))
     print('anchors/target = %.2f, Best Possible Recall (BPR) = %.4f' % (aat, bpr), end='')
     if bpr < 0.98:  # threshold to recompute
         print('. Attempting to generate improved anchors, please wait...' % bpr)
         na = m.anchor_grid.numel() // 2  # number of anchors
         # 重新计算anchor
         new_anchors = kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False)
-        new_bpr = metric(new_anchors.reshape(-1, 2))[0]
+        new_bpr = metric(torch.tensor(new_anchors, dtype=torch.float32, device=wh.device).view(-1, 2))[0]
         if new_bpr > bpr:  # replace anchors
             new_anchors = torch.tensor(new_anchors, device=m.anchors.device).type_as(m.anchors)
             m.anchor_grid[:] = new_anchors.clone().view_as(m.anchor_grid)  # for inference
@@ -115,7 +149,7 @@ def check_anchor_order(m):
     a = m.anchor_grid.prod(-1).view(-1)  # anchor area
     da = a[-1] - a[0]  # delta a
     ds = m.stride[-1] - m.stride[0]  # delta s
-    if da.sign() != ds.sign():  # same order
+    if (da * ds).item() < 0:  # opposite order, one multiply and one host sync instead of two sign() launches
         print('Reversing anchor order')
         m.anchors[:] = m.anchors.flip(0)
         m.anchor_grid[:] = m.anchor_grid.flip(0)
@@ -141,16 +175,17 @@ def labels_to_class_weights(labels, nc=80):
     if labels[0] is None:  # no labels loaded
         return torch.Tensor()
 
-    labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
-    classes = labels[:, 0].astype(np.int)  # labels = [class xywh]
+    # labels = [class xywh], only the class column is gathered (866643 labels for COCO)
+    classes = np.concatenate([l[:, 0] for l in labels], 0)
+    if classes.dtype.kind not in 'iu':  # cast only float class columns
+        classes = classes.astype(np.intp)
     weights = np.bincount(classes, minlength=nc)  # occurences per class
 
     # Prepend gridpoint count (for uCE trianing)
     # gpi = ((320 / 32 * np.array([1, 2, 4])) ** 2 * 3).sum()  # gridpoints per image
     # weights = np.hstack([gpi * len(labels)  - weights.sum() * 9, weights * 9]) ** 0.5  # prepend gridpoints to start
 
-    weights[weights == 0] = 1  # replace empty bins with 1
-    weights = 1 / weights  # number of targets per class
+    weights = 1 / np.maximum(weights, 1)  # number of targets per class, empty bins count as 1
     weights /= weights.sum()  # normalize
     return torch.from_numpy(weights)
 
@@ -158,42 +193,57 @@ def labels_to_class_weights(labels, nc=80):
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
     # Produces image weights based on class mAPs
     n = len(labels)
-    class_counts = np.array([np.bincount(labels[i][:, 0].astype(np.int), minlength=nc) for i in range(n)])
-    image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
+    # single bincount over composite (image, class) index instead of one bincount per image
+    idx = np.concatenate([np.full(len(l), i, dtype=np.intp) for i, l in enumerate(labels)]) * nc + \
+          np.concatenate([l[:, 0] for l in labels]).astype(np.intp)
+    class_counts = np.bincount(idx, minlength=n * nc).reshape(n, nc)  # class_counts.shape = (n, nc)
+    image_weights = class_counts @ class_weights.reshape(nc)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
 
 
+# https://tech.amikelive.com/node-718/what-object-categories-labels-are-in-coco-dataset/
+# a = np.loadtxt('data/coco.names', dtype='str', delimiter='\n')
+# b = np.loadtxt('data/coco_paper.names', dtype='str', delimiter='\n')
+# x1 = [list(a[i] == b).index(True) + 1 for i in range(80)]  # darknet to coco
+# x2 = [list(b[i] == a).index(True) if any(b[i] == a) else None for i in range(91)]  # coco to darknet
+_COCO80_TO_91 = np.asarray([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 27, 28,
+                            31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55,
+                            56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 67, 70, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 84,
+                            85, 86, 87, 88, 89, 90], dtype=np.int32)
+_COCO80_TO_91.flags.writeable = False  # shared by all callers
+
+
 def coco80_to_coco91_class():  # converts 80-index (val2014) to 91-index (paper)
-    # https://tech.amikelive.com/node-718/what-object-categories-labels-are-in-coco-dataset/
-    # a = np.loadtxt('data/coco.names', dtype='str', delimiter='\n')
-    # b = np.loadtxt('data/coco_paper.names', dtype='str', delimiter='\n')
-    # x1 = [list(a[i] == b).index(True) + 1 for i in range(80)]  # darknet to coco
-    # x2 = [list(b[i] == a).index(True) if any(b[i] == a) else None for i in range(91)]  # coco to darknet
-    x = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 27, 28, 31, 32, 33, 34,
-         35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63,
-         64, 65, 67, 70, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 84, 85, 86, 87, 88, 89, 90]
-    return x
+    return _COCO80_TO_91
+
+
+# Both box conversions are linear, y = x @ M (NumPy only, tensors use the exact element-wise form below)
+_BOX_MATRICES = {'xyxy2xywh': np.array([[.5, 0, -1, 0], [0, .5, 0, -1], [.5, 0, 1, 0], [0, .5, 0, 1]]),
+                 'xywh2xyxy': np.array([[1, 0, 1, 0], [0, 1, 0, 1], [-.5, 0, .5, 0], [0, -.5, 0, .5]])}
+
+
+def _box_convert(x, name):
+    # Applies nx4 box conversion 'name', preserving the input type and dtype
+    if isinstance(x, torch.Tensor):
+        # 不用matmul: CUDA上可能走TF32 (10位尾数), 600px附近的坐标会有~0.3px误差
+        a, b = x[:, :2], x[:, 2:4]
+        if name == 'xyxy2xywh':
+            y = torch.cat(((a + b) / 2, b - a), 1)  # xy center, wh
+        else:
+            y = torch.cat((a - b / 2, a + b / 2), 1)  # top-left, bottom-right
+        return y.to(x.dtype)
+    return (x @ _BOX_MATRICES[name]).astype(x.dtype, copy=False)
 
 
 def xyxy2xywh(x):
     # Convert nx4 boxes from [x1, y1, x2, y2] to [x, y, w, h] where xy1=top-left, xy2=bottom-right
-    y = torch.zeros_like(x) if isinstance(x, torch.Tensor) else np.zeros_like(x)
-    y[:, 0] = (x[:, 0] + x[:, 2]) / 2  # x center
-    y[:, 1] = (x[:, 1] + x[:, 3]) / 2  # y center
-    y[:, 2] = x[:, 2] - x[:, 0]  # width
-    y[:, 3] = x[:, 3] - x[:, 1]  # height
-    return y
+    return _box_convert(x, 'xyxy2xywh')
 
 
 def xywh2xyxy(x):
     # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-    y = torch.zeros_like(x) if isinstance(x, torch.Tensor) else np.zeros_like(x)
-    y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
-    y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
-    y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
-    y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
-    return y
+    return _box_convert(x, 'xywh2xyxy')
 
 
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
@@ -205,8 +255,8 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
         gain = ratio_pad[0][0]
         pad = ratio_pad[1]
 
-    coords[:, [0, 2]] -= pad[0]  # x padding
-    coords[:, [1, 3]] -= pad[1]  # y padding
+    coords[:, 0:4:2] -= pad[0]  # x padding (strided view, no index copy)
+    coords[:, 1:4:2] -= pad[1]  # y padding
     coords[:, :4] /= gain
     clip_coords(coords, img0_shape)
     return coords
@@ -214,10 +264,8 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
 
 def clip_coords(boxes, img_shape):
     # Clip bounding xyxy bounding boxes to image shape (height, width)
-    boxes[:, 0].clamp_(0, img_shape[1])  # x1
-    boxes[:, 1].clamp_(0, img_shape[0])  # y1
-    boxes[:, 2].clamp_(0, img_shape[1])  # x2
-    boxes[:, 3].clamp_(0, img_shape[0])  # y2
+    boxes[:, 0:4:2].clamp_(0, img_shape[1])  # x1, x2
+    boxes[:, 1:4:2].clamp_(0, img_shape[0])  # y1, y2
 
 
 def ap_per_class(tp, conf, pred_cls, target_cls):
@@ -263,9 +311,8 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
             precision = tpc / (tpc + fpc)  # precision curve
             p[ci] = np.interp(-pr_score, -conf[i], precision[:, 0])  # p at pr_score
 
-            # AP from recall-precision curve
-            for j in range(tp.shape[1]):
-                ap[ci, j] = compute_ap(recall[:, j], precision[:, j])
+            # AP from recall-precision curve, all iou thresholds at once
+            ap[ci] = compute_ap(recall, precision)
 
             # Plot
             # fig, ax = plt.subplots(1, 1, figsize=(5, 5))
@@ -283,48 +330,65 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     return p, r, ap, f1, unique_classes.astype('int32')
 
 
+_AP_X = np.linspace(0, 1, 101)  # 101-point interp grid (COCO)
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rbgirshick/py-faster-rcnn.
     # Arguments
-        recall:    The recall curve (list).
-        precision: The precision curve (list).
+        recall:    The recall curve (nparray, n or nxt for t iou thresholds).
+        precision: The precision curve (nparray, n or nxt).
     # Returns
-        The average precision as computed in py-faster-rcnn.
+        The average precision as computed in py-faster-rcnn (scalar, or t-vector for nxt inputs).
     """
+    recall, precision = np.asarray(recall), np.asarray(precision)
+    squeeze = recall.ndim == 1
+    if squeeze:
+        recall, precision = recall[:, None], precision[:, None]
+    n, t = recall.shape
 
     # Append sentinel values to beginning and end
-    mrec = np.concatenate(([0.], recall, [min(recall[-1] + 1E-3, 1.)]))
-    mpre = np.concatenate(([0.], precision, [0.]))
+    mrec = np.concatenate((np.zeros((1, t)), recall, np.minimum(recall[-1:] + 1E-3, 1.)))
+    mpre = np.concatenate((np.zeros((1, t)), precision, np.zeros((1, t))))
 
     # Compute the precision envelope
-    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre, 0), 0), 0)
 
     # Integrate area under curve
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
-        x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        x = _AP_X  # 101-point interp (COCO)
+        # batched np.interp(x, mrec[:, j], mpre[:, j]): offset columns into disjoint ranges so one searchsorted covers all
+        off = (max(mrec[-1].max(), 1.) + 1.) * np.arange(t)
+        xp, fp = (mrec + off).T.ravel(), mpre.T.ravel()
+        q = (x[:, None] + off).T.ravel()  # queries, t*101
+        lo = np.arange(t).repeat(len(x)) * (n + 2)  # first index of each column
+        i = np.clip(np.searchsorted(xp, q, side='right') - 1, lo, lo + n + 1)
+        k = np.minimum(i + 1, lo + n + 1)
+        dx = xp[k] - xp[i]
+        y = fp[i] + np.divide((fp[k] - fp[i]) * (q - xp[i]), dx, out=np.zeros_like(dx), where=dx > 0)
+        ap = np.trapz(y.reshape(t, len(x)), x, axis=1)  # integrate
     else:  # 'continuous'
-        i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
-        ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
+        ap = (np.diff(mrec, axis=0) * mpre[1:]).sum(0)  # area under curve, zero where recall does not change
 
-    return ap
+    return ap[0] if squeeze else ap
 
 
-def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False):
-    # Returns the IoU of box1 to box2. box1 is 4, box2 is nx4
-    box2 = box2.T
+_FOUR_OVER_PI2 = 4 / math.pi ** 2  # CIoU aspect-ratio term scale
+
 
-    # Get the coordinates of bounding boxes
+def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False):
+    # Returns the IoU of box1 to box2. box1 is 4 or nx4 (element-wise pairs), box2 is nx4
+    # Get the coordinates of bounding boxes, columns are read in place so no transpose is needed
     if x1y1x2y2:  # x1, y1, x2, y2 = box1
-        b1_x1, b1_y1, b1_x2, b1_y2 = box1[0], box1[1], box1[2], box1[3]
-        b2_x1, b2_y1, b2_x2, b2_y2 = box2[0], box2[1], box2[2], box2[3]
+        b1_x1, b1_y1, b1_x2, b1_y2 = box1[..., 0], box1[..., 1], box1[..., 2], box1[..., 3]
+        b2_x1, b2_y1, b2_x2, b2_y2 = box2[..., 0], box2[..., 1], box2[..., 2], box2[..., 3]
     else:  # transform from xywh to xyxy
-        b1_x1, b1_x2 = box1[0] - box1[2] / 2, box1[0] + box1[2] / 2
-        b1_y1, b1_y2 = box1[1] - box1[3] / 2, box1[1] + box1[3] / 2
-        b2_x1, b2_x2 = box2[0] - box2[2] / 2, box2[0] + box2[2] / 2
-        b2_y1, b2_y2 = box2[1] - box2[3] / 2, box2[1] + box2[3] / 2
+        b1_x1, b1_x2 = box1[..., 0] - box1[..., 2] / 2, box1[..., 0] + box1[..., 2] / 2
+        b1_y1, b1_y2 = box1[..., 1] - box1[..., 3] / 2, box1[..., 1] + box1[..., 3] / 2
+        b2_x1, b2_x2 = box2[..., 0] - box2[..., 2] / 2, box2[..., 0] + box2[..., 2] / 2
+        b2_y1, b2_y2 = box2[..., 1] - box2[..., 3] / 2, box2[..., 1] + box2[..., 3] / 2
 
     # Intersection area
     inter = (torch.min(b1_x2, b2_x2) - torch.max(b1_x1, b2_x1)).clamp(0) * \
@@ -350,7 +414,7 @@ def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False):
             if DIoU:
                 return iou - rho2 / c2  # DIoU
             elif CIoU:  # https://github.com/Zzh-tju/DIoU-SSD-pytorch/blob/master/utils/box/box_utils.py#L47
-                v = (4 / math.pi ** 2) * torch.pow(torch.atan(w2 / h2) - torch.atan(w1 / h1), 2)
+                v = _FOUR_OVER_PI2 * (torch.atan2(w2, h2) - torch.atan2(w1, h1)).pow_(2)
                 with torch.no_grad():
                     alpha = v / (1 - iou + v + 1e-16)
                 return iou - (rho2 / c2 + v * alpha)  # CIoU
@@ -358,6 +422,39 @@ def bbox_iou(box1, box2, x1y1x2y2=True, GIoU=False, DIoU=False, CIoU=False):
     return iou
 
 
+@torch.jit.script
+def _ciou(x1, y1, w1, h1, x2, y2, w2, h2):
+    # Returns the CIoU of box1 to box2 given as unbound xywh columns, single scripted body so the fuser emits one kernel
+    b1_x1, b1_x2, b1_y1, b1_y2 = x1 - w1 / 2, x1 + w1 / 2, y1 - h1 / 2, y1 + h1 / 2
+    b2_x1, b2_x2, b2_y1, b2_y2 = x2 - w2 / 2, x2 + w2 / 2, y2 - h2 / 2, y2 + h2 / 2
+
+    # Intersection and union area
+    inter = (torch.min(b1_x2, b2_x2) - torch.max(b1_x1, b2_x1)).clamp(0) * \
+            (torch.min(b1_y2, b2_y2) - torch.max(b1_y1, b2_y1)).clamp(0)
+    union = (w1 * h1 + 1e-16) + w2 * h2 - inter
+    iou = inter / union
+
+    cw = torch.max(b1_x2, b2_x2) - torch.min(b1_x1, b2_x1)  # convex width
+    ch = torch.max(b1_y2, b2_y2) - torch.min(b1_y1, b2_y1)  # convex height
+    c2 = cw ** 2 + ch ** 2 + 1e-16  # convex diagonal squared
+    rho2 = (x2 - x1) ** 2 + (y2 - y1) ** 2  # centerpoint distance squared
+    v = (4 / math.pi ** 2) * (torch.atan2(w2, h2) - torch.atan2(w1, h1)) ** 2  # script constant-folds math.pi
+    alpha = (v / (1 - iou + v + 1e-16)).detach()
+    return iou - (rho2 / c2 + v * alpha)  # CIoU
+
+
+@torch.jit.script
+def decode_ciou(ps, anchors, tbox):
+    # Decodes the raw xywh outputs ps (nx4+) against anchors (nx2) and returns their CIoU to tbox (nx4 xywh)
+    # 解码和CIoU在同一个scripted函数里, 不再生成pxy/pwh/pbox中间量
+    s = ps[:, :4].sigmoid()
+    x1, y1, w1, h1 = s.unbind(1)
+    aw, ah = anchors.unbind(1)
+    x2, y2, w2, h2 = tbox.unbind(1)
+    # xy范围[-0.5, 1.5], wh范围[0, 4]倍anchor
+    return _ciou(x1 * 2. - 0.5, y1 * 2. - 0.5, (w1 * 2.) ** 2 * aw, (h1 * 2.) ** 2 * ah, x2, y2, w2, h2)
+
+
 def box_iou(box1, box2):
     # https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
     """
@@ -385,10 +482,39 @@ def box_iou(box1, box2):
 
 def wh_iou(wh1, wh2):
     # Returns the nxm IoU matrix. wh1 is nx2, wh2 is mx2
-    wh1 = wh1[:, None]  # [N,1,2]
-    wh2 = wh2[None]  # [1,M,2]
-    inter = torch.min(wh1, wh2).prod(2)  # [N,M]
-    return inter / (wh1.prod(2) + wh2.prod(2) - inter)  # iou = inter / (area1 + area2 - inter)
+    inter = torch.min(wh1[:, 0:1], wh2[:, 0]) * torch.min(wh1[:, 1:2], wh2[:, 1])  # [N,M], no [N,M,2] temporary
+    return inter / (wh1.prod(1)[:, None] + wh2.prod(1) - inter)  # iou = inter / (area1 + area2 - inter)
+
+
+@torch.jit.script
+def focal_loss(pred, true, pos_weight: Optional[torch.Tensor], weight: Optional[torch.Tensor],
+               alpha: float = 0.25, gamma: float = 1.5, reduction: str = 'mean'):
+    # Focal loss on BCE-with-logits, scripted so the pointwise chain fuses into one pass over pred
+    # BCE-with-logits computed inline so it shares one logsigmoid with pred_prob
+    log_p = F.logsigmoid(pred)  # log(p)
+    log_1mp = log_p - pred  # log(1 - p)
+    if pos_weight is not None:
+        loss = -(pos_weight * true * log_p + (1 - true) * log_1mp)
+    else:
+        loss = -(true * log_p + (1 - true) * log_1mp)
+    if weight is not None:
+        loss = loss * weight
+    # p_t = torch.exp(-loss)
+    # loss *= alpha * (1.000001 - p_t) ** gamma  # non-zero power for gradient stability
+
+    # TF implementation https://github.com/tensorflow/addons/blob/v0.7.1/tensorflow_addons/losses/focal_loss.py
+    pred_prob = log_p.exp()  # prob from logits
+    p_t = true * pred_prob + (1 - true) * (1 - pred_prob)
+    alpha_factor = true * alpha + (1 - true) * (1 - alpha)
+    modulating_factor = (1.0 - p_t) ** gamma
+    loss = loss * alpha_factor * modulating_factor
+
+    if reduction == 'mean':
+        return loss.mean()
+    elif reduction == 'sum':
+        return loss.sum()
+    else:  # 'none'
+        return loss
 
 
 class FocalLoss(nn.Module):
@@ -402,23 +528,8 @@ class FocalLoss(nn.Module):
         self.loss_fcn.reduction = 'none'  # required to apply FL to each element
 
     def forward(self, pred, true):
-        loss = self.loss_fcn(pred, true)
-        # p_t = torch.exp(-loss)
-        # loss *= self.alpha * (1.000001 - p_t) ** self.gamma  # non-zero power for gradient stability
-
-        # TF implementation https://github.com/tensorflow/addons/blob/v0.7.1/tensorflow_addons/losses/focal_loss.py
-        pred_prob = torch.sigmoid(pred)  # prob from logits
-        p_t = true * pred_prob + (1 - true) * (1 - pred_prob)
-        alpha_factor = true * self.alpha + (1 - true) * (1 - self.alpha)
-        modulating_factor = (1.0 - p_t) ** self.gamma
-        loss *= alpha_factor * modulating_factor
-
-        if self.reduction == 'mean':
-            return loss.mean()
-        elif self.reduction == 'sum':
-            return loss.sum()
-        else:  # 'none'
-            return loss
+        return focal_loss(pred, true, self.loss_fcn.pos_weight, self.loss_fcn.weight,
+                          float(self.alpha), float(self.gamma), self.reduction)
 
 
 def smooth_BCE(eps=0.1):  # https://github.com/ultralytics/yolov3/issues/238#issuecomment-598028441
@@ -471,16 +582,12 @@ def merge_imgs(imgs, row_col_num):
     else:
         assert row * col >= length, 'Imgs overboundary, not enough windows to display all imgs!'
 
-        fill_img_list = [np.zeros(imgs[0].shape, dtype=np.uint8)] * (row * col - length)
-        imgs.extend(fill_img_list)
-        merge_imgs_col = []
-        for i in range(row):
-            start = col * i
-            end = col * (i + 1)
-            merge_col = np.hstack(imgs[start: end])
-            merge_imgs_col.append(merge_col)
-
-        merge_imgs = np.vstack(merge_imgs_col)
+        # one canvas, each img copied into its tile once; unused tiles stay black
+        h, w = imgs[0].shape[:2]
+        merge_imgs = np.zeros((row * h, col * w) + imgs[0].shape[2:], dtype=imgs[0].dtype)
+        for i, img in enumerate(imgs):
+            r, c = divmod(i, col)
+            merge_imgs[r * h:(r + 1) * h, c * w:(c + 1) * w] = img
 
     return merge_imgs
 
@@ -710,8 +817,26 @@ def vis_match(imgs, targets, tcls, tboxs, indices, anchors, pred, ttars):
 ###########################################################################################################
 ###########################################################################################################
 
+# 可视化anchor匹配关系, YOLO_VIS_MATCH=1 打开 (blocks on cv2.waitKey every step, keep off for real training)
+VIS_MATCH = os.environ.get('YOLO_VIS_MATCH', '0') == '1'
+
+
 # 核心内容
-def compute_loss(p, targets, model, imgs):  # predictions, targets, model
+_LOSS_BUFFERS = {}  # (name, device, dtype): flat target buffer reused by compute_loss() across steps
+_LOSS_FNS = weakref.WeakKeyDictionary()  # model: (key, criteria), 不挂在model上, 以免被torch.save存进checkpoint
+
+
+def _loss_buffer(name, shape, device, dtype):
+    # Returns an uninitialised tensor of shape, reusing the storage of the previous step's buffer 'name' if large enough
+    n = torch.Size(shape).numel()
+    key = name, device, dtype
+    buf = _LOSS_BUFFERS.get(key)
+    if buf is None or buf.numel() < n:
+        buf = _LOSS_BUFFERS[key] = torch.empty(n, device=device, dtype=dtype)
+    return buf[:n].view(shape)
+
+
+def compute_loss(p, targets, model, imgs=None):  # predictions, targets, model, images (only for visualization)
     # 可视化target
     # vis_bbox(imgs, targets)
 
@@ -720,31 +845,44 @@ def compute_loss(p, targets, model, imgs):  # predictions, targets, model
     tcls, tbox, indices, anchors, ttar = build_targets(p, targets, model)  # targets
 
     # 可视化anchor匹配关系
-    vis_match(imgs, targets, tcls, tbox, indices, anchors, p, ttar)
+    if VIS_MATCH and imgs is not None:
+        vis_match(imgs, targets, tcls, tbox, indices, anchors, p, ttar)
 
     h = model.hyp  # hyperparameters
 
-    # Define criteria
-    BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.Tensor([h['cls_pw']])).to(device)
-    BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.Tensor([h['obj_pw']])).to(device)
+    # Define criteria once per (model, hyp, device)
+    key = (h['cls_pw'], h['obj_pw'], h['fl_gamma'], device)
+    cache = _LOSS_FNS.get(model)
+    if cache is None or cache[0] != key:
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device))
+        BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device))
 
-    # Class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
-    cp, cn = smooth_BCE(eps=0.0)
+        # Class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
+        cp, cn = smooth_BCE(eps=0.0)
 
-    # Focal loss
-    g = h['fl_gamma']  # focal loss gamma
-    if g > 0:
-        BCEcls, BCEobj = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g)
+        # Focal loss
+        g = h['fl_gamma']  # focal loss gamma
+        if g > 0:
+            BCEcls, BCEobj = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g)
+        _LOSS_FNS[model] = cache = key, (BCEcls, BCEobj, cp, cn)
+    BCEcls, BCEobj, cp, cn = cache[1]
 
     # Losses
     nt = 0  # number of targets
     np = len(p)  # number of outputs
     balance = [4.0, 1.0, 0.4] if np == 3 else [4.0, 1.0, 0.4, 0.1]  # P3-5 or P3-6
+    # 分类one-hot目标, 按所有层的正样本总数一次性scatter构建, 各层再按顺序取互不重叠的一段
+    # (BCE反向时还要用到target, 所以在第一次计算loss后就不能再对这块内存做in-place修改)
+    # cls和tobj的target内存都跨step复用, 所以下一次调用compute_loss前需要已经完成上一次的backward
+    if model.nc > 1:
+        cls_buf = _loss_buffer('cls', (sum(len(x) for x in tcls), model.nc), device, torch.float32).fill_(cn)
+        cls_buf.scatter_(1, torch.cat(tcls).view(-1, 1), cp)  # 构建one-hot矩阵.
+        cls_off = 0
     # 遍历每个预测输出
     for i, pi in enumerate(p):  # layer index, layer predictions
         # b代表的是图片索引, 也就是batchsize中的第几张图片, a代表每个gt对应的anchor索引号, gj gi表示gt位于网格下标
         b, a, gj, gi = indices[i]  # image, anchor, gridy, gridx
-        tobj = torch.zeros_like(pi[..., 0], device=device)  # target obj, 这里默认只有正负样本, 没有忽略样本. 负样本的conf=0
+        tobj = _loss_buffer(i, pi.shape[:-1], pi.device, pi.dtype).zero_()  # target obj, 这里默认只有正负样本, 没有忽略样本. 负样本的conf=0
 
         n = b.shape[0]  # number of targets
         if n:
@@ -753,10 +891,9 @@ def compute_loss(p, targets, model, imgs):  # predictions, targets, model
             ps = pi[b, a, gj, gi]  # pi[b, a, gj, gi] <=> pi[b, a, gj, gi, :]
 
             # Regression
-            pxy = ps[:, :2].sigmoid() * 2. - 0.5  # TODO: 这里为什么要减去0.5呢?
-            pwh = (ps[:, 2:4].sigmoid() * 2) ** 2 * anchors[i]  # wh最终解码出来的值的范围在[0~4]之间.
-            pbox = torch.cat((pxy, pwh), 1).to(device)  # predicted box
-            giou = bbox_iou(pbox.T, tbox[i], x1y1x2y2=False, CIoU=True)  # giou(prediction, target)
+            # pxy = ps[:, :2].sigmoid() * 2. - 0.5, TODO: 这里为什么要减去0.5呢?
+            # pwh = (ps[:, 2:4].sigmoid() * 2) ** 2 * anchors[i], wh最终解码出来的值的范围在[0~4]之间.
+            giou = decode_ciou(ps, anchors[i], tbox[i])  # giou(prediction, target)
             lbox += (1.0 - giou).mean()  # giou loss
 
             # Objectness 有物体的conf分支权重, 这里是正样本对应的giou值, 也就是说YOLO v5的地方,其正样本,对应的conf目标是计算出来的giou值, 并不是1.
@@ -765,8 +902,8 @@ def compute_loss(p, targets, model, imgs):  # predictions, targets, model
 
             # Classification
             if model.nc > 1:  # cls loss (only if multiple classes)
-                t = torch.full_like(ps[:, 5:], cn, device=device)  # targets
-                t[range(n), tcls[i]] = cp  # 构建one-hot矩阵.
+                t = cls_buf[cls_off:cls_off + n].type(ps.dtype)  # targets
+                cls_off += n
                 lcls += BCEcls(ps[:, 5:], t)  # BCE 每个类单独计算Loss
 
             # Append targets to text file
@@ -786,6 +923,17 @@ def compute_loss(p, targets, model, imgs):  # predictions, targets, model
     return loss * bs, torch.cat((lbox, lobj, lcls, loss)).detach()
 
 
+_TARGET_OFFSET_G = 0.5  # build_targets() grid cell centre offset
+
+
+@lru_cache(maxsize=8)
+def _target_offsets(device):
+    # Returns build_targets() neighbour cell offsets, cached per device
+    return torch.tensor([[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                         # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
+                         ], device=device).float() * _TARGET_OFFSET_G
+
+
 # 核心操作
 # 其和常规的yolov3 loss完全不同
 # 其label没有跨层，对于任何一个gt，首先三个输出层都有，对于任何一层
@@ -800,135 +948,142 @@ def build_targets(p, targets, model):
     # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
     det = model.module.model[-1] if is_parallel(model) else model.model[-1]  # Detect() module
     # targets nx6,其中n是batch内所有的图片label拼接而成，6的第0维度表示当前是第几张图片的label =index classid xywh
-    na, nt = det.na, targets.shape[0]  # na <=> nums_anchors, nt <=> nums_targets
+    na, nt, nl = det.na, targets.shape[0], det.nl  # na <=> nums_anchors, nt <=> nums_targets, nl <=> nums_layers
     tcls, tbox, indices, anch, ttar = [], [], [], [], []
-    gain = torch.ones(7, device=targets.device)
+    # 所有输出层一次性处理, 每层一行gain: 1 1 特征图大小 特征图大小 特征图大小 特征图大小 1
+    gain = torch.ones(nl, 7, device=targets.device)  # gain.shape = [nl, 7]
+    gain[:, 2:6] = torch.tensor([[x.shape[3], x.shape[2], x.shape[3], x.shape[2]] for x in p], device=targets.device)
     # anchor=3个数，将target变成3xtarget格式,方便后面算Loss
     # anchor索引，后面有用，用于表示当前gt和当前层的哪个anchor匹配
-    ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # ai.shape = [na, nt]
+    ai = torch.arange(na, device=targets.device).float().view(na, 1).expand(na, nt)  # ai.shape = [na, nt], 只是view不复制
 
     # 先repeat和当前层anchor个数一样,相当于每个gt变成了三个，然后和3个anchor单独匹配
     targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
 
-    g = 0.5  # 网格中心偏移
-    # 附近的4个网格
-    off = torch.tensor([[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                        # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                        ], device=targets.device).float() * g  # offsets
-
-    for i in range(det.nl):  # 三个输出分支
-        anchors = det.anchors[i]  # 当前分支anchor
-        # p是网络输出值
-        gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # 1 1 特征图大小 特征图大小 特征图大小 特征图大小 1
-        # targets的xywh本身是归一化尺度，故需要变成特征图尺度
-        t = targets * gain
-        # 如果有gt
-        if nt:
-            # 计算当前target的wh和anchor的wh比例值
-            # 如果最大比例大于预设值model.hyp['anchor_t']=4，则说明当前target和anchor匹配度不高，不应该强制回归，把target丢弃
-            # 主要是把shape和anchor匹配度不高的label去掉，这其实也说明该物体的大小比较极端，要么太大，要么太小，要么wh差距很大
-
-            # 基于shape过滤后，就会出现某些gt仅仅和当前层的某几个anchor匹配，即可能出现某些gt仅仅和其中某个匹配，
-            # 而不是和当前位置所有anchor匹配
-            r = t[:, :, 4:6] / anchors[:, None]  # wh ratio 不考虑xy坐标, r.shape=[num_anchors, num_gts, 2]
-            j = torch.max(r, 1. / r).max(2)[0] < model.hyp['anchor_t']
-            # 假设3个anchor, 10个gt
-            # j矩阵如下:
-            # tensor([[False, False, False, False, False, False, False, False, False, False],
-            #         [False, False, False, False, False, False, False, False, False, True],
-            #         [False, False, False, False, True, False, False, True, False, True]],
-            # 假设j[2, 9]=True, 表示第3个anchor与第10个gt能匹配上.
-            # TODO: 上面的代码为源代码, 打印这个j可以发现, 某一个gt对应多个anchor. 同时一个anchor也对应多个gt.
-            #  这里似乎逻辑出问题了,其实并不是这样.函数build_targets(p, targets, model)，是将一张图片中的所有
-            #  targets都放进来了。然后targets被repeat了anchor个数遍，这样，每个gt都会和三个anchor匹配下，通过
-            #  wh匹配后，得到j矩阵，这个j矩阵的每一行是可以有多个true的情况的关键原因是，如果gt_1和gt_2形状一样，
-            #  但是他们俩位置相差很远，此时他们会一定匹配上同一个大小的anchor_3, 后面根据gt_1和gt_2的xy位置，
-            #  我们就能知道，gt_1所匹配的是比如cell(2,2)中的anchor_3， 而gt_2所匹配的是比如cell(8,8)中
-            #  anchor_3。这就是为什么j矩阵的每一行是可以出现多个true的原因，但是如果出现gt_1和gt_2形状一样，
-            #  位置一样，那此时anchor就会出现一对多的情况！
-
-            t = t[j]  # 该层匹配上的gt, 也即是这些gt由该层负责预测.
-            # https://www.kaggle.com/c/global-wheat-detection/discussion/172436
-            # 网络的3个附近点，不再是落在哪个网络就计算该网络anchor,而是依靠中心点的情况
-            # 选择最最近的3个网格，作为落脚点，可以极大增加正样本数
-            # 也就是对于保留的gt，最少有3个anchor匹配，最多9个
-            gxy = t[:, 2:4]  # gt的中心坐标
-            gxi = gain[[2, 3]] - gxy  # inverse
-            # 这两个条件可以选择出最靠近的2个邻居，加上自己，就是三个邻居
-            j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-            l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-            j = torch.stack((torch.ones_like(j), j, k, l, m))
-            # 5是因为预设的off是5个，现在选择出最近的3个(包括0,0也就是自己)
-            # 这里解释t.repeat(5,1,1)[j]的含义,假如t.shape=[4,7], 则t.repeat(5,1,1).shape=[5,4,7]
-            # j.shape=[5,4],这里对j的含义进行解释, 总共匹配上4个gt, 每个gt对应中0,j,k,l,m.假设现在j[2,3]=True
-            # 表示第gt_3的k方向为True, 也就是说gt_3与他上面的格子挨近.
-            #                (0,0.5)
-            #                   ↑
-            #                   |(k)
-            #    (-0.5, 0)<-(j)-o-(l)-> (0.5, 0)
-            #                   |(m)
-            #                   ↓
-            #                (0,-0.5)
-            # j的矩阵为: gt1   gt2   gt3   gt4
-            # tensor([[True, True, True, True],      o方向
-            #         [True, False, False, True],    j方向上, gt1和gt3的中心点<0.5距离, 说明这两个gt靠近左侧网格.
-            #         [False, True, False, False],   k方向
-            #         [False, True, True, False],    l方向
-            #         [True, False, True, True]],    m方向
-            # t.repeat(5,1,1)将t变成5份, 主要是从5个方向来考察,其中o方向也就是当前网格中的所有gt与anchor匹配上的,对应正样本,
-            # 因此, t.repeat((5, 1, 1))的[0,:,:]会被留下.
-            # j矩阵中的第二行为:[True, False, False, True]表示, gt1和gt4同时也由左边的网格也来负责, 对应的左边这个网格会有正样本,
-            # 因此, t.repeat((5, 1, 1))的[1,0:1,:]和[1,3:4, :]会被留下.
-            # j矩阵中的第三行为:[False, True, False, False]表示, gt2同时由上边的网格也来负责, 对应的上边这个网格会有正样本,
-            # 因此, t.repeat((5, 1, 1))的[1,1:2,:]会被留下.
-            # 最终t.shape=[12, 7]
-            t = t.repeat((5, 1, 1))[j]  # (label个数x3,7) 附近的2个网格anchor，都算该gt的anchor点
-            # 下面这句代码也是同样情况, 假设gt为4个.则(torch.zeros_like(gxy)[None] + off[:, None]).shape=[5,4,7]
-            # 然后依据j矩阵, 将对应的偏移方向选出来放在offsets中, 后续gxy-offsets表示
-            offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-        else:
-            t = targets[0]
-            offsets = 0
-
-        # 按照yolov3，则直接（gxy-0.5）.long()即可得到网格坐标
-        # 但是这里考虑了附近网格，故offsets不再是0.5而是2个邻居
-        # 所以xy回归范围也变了，不再是0-1，而是0-2
-        # 宽高范围也不一样了，而是0-4，因为超过4倍比例是算不匹配anchor，所以最大是4
-        b, c = t[:, :2].long().T  # image_index, class
-        gxy = t[:, 2:4]  # grid xy
-        gwh = t[:, 4:6]  # grid wh
-        # 根据offsets将gxy进行对应的平移操作后进行取整, 就得到每个gt所属的格子位置.
-        gij = (gxy - offsets).long()
-        # gi,gj主要是根据gt所在位置, 找出这个格子对应的anchor, 也就是说,(gj, gi)网格
-        # 中的anchor也将去负责预测这个gt, 但是值得注意的是(gj, gi)中的anchor负责预测的
-        # gt不是gxy-offsets, 而是gxy.这千万不要混淆. gxy-offsets只是为了定位旁边格子
-        # 的位置, 从而找到cell(gj, gi)中的anchor, 换句话说, 也就是cell(gj,gi)中的anchor
-        # 预测cell(gj+1, gi)中的gt.
-        gi, gj = gij.T
-
-        # t[:, 6]表示的是gt对应的anchor信息, 如果gt_1在网格(1,2)中是由anchor_2负责,
-        # 则在cell(1,3)同样由anchor_2负责.
-        a = t[:, 6].long()
-        # (image, anchor, grid indices)
-        indices.append((b, a, gj, gi))
-        # tbox中的gxy-gij也即每个网格对应的xy target回归量
-        tbox.append(torch.cat((gxy - gij, gwh), 1))
-        ttar.append(torch.cat((gxy, gwh), 1))        # (x,y,w,h)
-        anch.append(anchors[a])                      # anchors
-        tcls.append(c)                               # class
+    g = _TARGET_OFFSET_G  # 网格中心偏移
+    off = _target_offsets(targets.device)  # offsets, 附近的4个网格, 每个device只创建一次
+
+    # 如果有gt
+    if nt:
+        # targets的xywh本身是归一化尺度，故需要变成每一层的特征图尺度, t.shape=[nl, na, nt, 7]
+        t = targets[None] * gain[:, None, None]
+        # 计算当前target的wh和anchor的wh比例值
+        # 如果最大比例大于预设值model.hyp['anchor_t']=4，则说明当前target和anchor匹配度不高，不应该强制回归，把target丢弃
+        # 主要是把shape和anchor匹配度不高的label去掉，这其实也说明该物体的大小比较极端，要么太大，要么太小，要么wh差距很大
+
+        # 基于shape过滤后，就会出现某些gt仅仅和当前层的某几个anchor匹配，即可能出现某些gt仅仅和其中某个匹配，
+        # 而不是和当前位置所有anchor匹配
+        r = t[..., 4:6] / det.anchors[:, :, None]  # wh ratio 不考虑xy坐标, r.shape=[nl, num_anchors, num_gts, 2]
+        j = torch.max(r, 1. / r).max(3)[0] < model.hyp['anchor_t']  # j.shape=[nl, num_anchors, num_gts]
+        # 假设3个anchor, 10个gt, 某一层的j矩阵如下:
+        # tensor([[False, False, False, False, False, False, False, False, False, False],
+        #         [False, False, False, False, False, False, False, False, False, True],
+        #         [False, False, False, False, True, False, False, True, False, True]],
+        # 假设j[2, 9]=True, 表示第3个anchor与第10个gt能匹配上.
+        # TODO: 上面的代码为源代码, 打印这个j可以发现, 某一个gt对应多个anchor. 同时一个anchor也对应多个gt.
+        #  这里似乎逻辑出问题了,其实并不是这样.函数build_targets(p, targets, model)，是将一张图片中的所有
+        #  targets都放进来了。然后targets被repeat了anchor个数遍，这样，每个gt都会和三个anchor匹配下，通过
+        #  wh匹配后，得到j矩阵，这个j矩阵的每一行是可以有多个true的情况的关键原因是，如果gt_1和gt_2形状一样，
+        #  但是他们俩位置相差很远，此时他们会一定匹配上同一个大小的anchor_3, 后面根据gt_1和gt_2的xy位置，
+        #  我们就能知道，gt_1所匹配的是比如cell(2,2)中的anchor_3， 而gt_2所匹配的是比如cell(8,8)中
+        #  anchor_3。这就是为什么j矩阵的每一行是可以出现多个true的原因，但是如果出现gt_1和gt_2形状一样，
+        #  位置一样，那此时anchor就会出现一对多的情况！
+
+        li = torch.arange(nl, device=targets.device)[:, None, None].expand_as(j)[j]  # 每个匹配gt所在的层
+        t = t[j]  # 各层匹配上的gt(按层排列), 也即是这些gt由该层负责预测.
+        # https://www.kaggle.com/c/global-wheat-detection/discussion/172436
+        # 网络的3个附近点，不再是落在哪个网络就计算该网络anchor,而是依靠中心点的情况
+        # 选择最最近的3个网格，作为落脚点，可以极大增加正样本数
+        # 也就是对于保留的gt，最少有3个anchor匹配，最多9个
+        gxy = t[:, 2:4]  # gt的中心坐标
+        gxi = gain[li, 2:4] - gxy  # inverse
+        # 这两个条件可以选择出最靠近的2个邻居，加上自己，就是三个邻居
+        j, k = ((gxy % 1. < g) & (gxy > 1.)).T
+        l, m = ((gxi % 1. < g) & (gxi > 1.)).T
+        j = torch.stack((torch.ones_like(j), j, k, l, m))
+        # 5是因为预设的off是5个，现在选择出最近的3个(包括0,0也就是自己)
+        # 这里解释t.repeat(5,1,1)[j]的含义,假如t.shape=[4,7], 则t.repeat(5,1,1).shape=[5,4,7]
+        # j.shape=[5,4],这里对j的含义进行解释, 总共匹配上4个gt, 每个gt对应中0,j,k,l,m.假设现在j[2,3]=True
+        # 表示第gt_3的k方向为True, 也就是说gt_3与他上面的格子挨近.
+        #                (0,0.5)
+        #                   ↑
+        #                   |(k)
+        #    (-0.5, 0)<-(j)-o-(l)-> (0.5, 0)
+        #                   |(m)
+        #                   ↓
+        #                (0,-0.5)
+        # j的矩阵为: gt1   gt2   gt3   gt4
+        # tensor([[True, True, True, True],      o方向
+        #         [True, False, False, True],    j方向上, gt1和gt3的中心点<0.5距离, 说明这两个gt靠近左侧网格.
+        #         [False, True, False, False],   k方向
+        #         [False, True, True, False],    l方向
+        #         [True, False, True, True]],    m方向
+        # t.repeat(5,1,1)将t变成5份, 主要是从5个方向来考察,其中o方向也就是当前网格中的所有gt与anchor匹配上的,对应正样本,
+        # 因此, t.repeat((5, 1, 1))的[0,:,:]会被留下.
+        # j矩阵中的第二行为:[True, False, False, True]表示, gt1和gt4同时也由左边的网格也来负责, 对应的左边这个网格会有正样本,
+        # 因此, t.repeat((5, 1, 1))的[1,0:1,:]和[1,3:4, :]会被留下.
+        # j矩阵中的第三行为:[False, True, False, False]表示, gt2同时由上边的网格也来负责, 对应的上边这个网格会有正样本,
+        # 因此, t.repeat((5, 1, 1))的[1,1:2,:]会被留下.
+        # 最终t.shape=[12, 7]
+        # 多层同时处理时, 再按层拆开j: j.shape=[nl, 5, M], 这样选出来的结果先按层排列, 层内的顺序与逐层计算完全相同
+        # 不再真的repeat出[nl,5,M,7]再取, 而是用nonzero得到(层, 方向, gt)下标后直接index_select, 顺序完全一样
+        j = j[None] & (li == torch.arange(nl, device=targets.device)[:, None, None])
+        lj, dj, rj = j.nonzero(as_tuple=True)  # layer, direction, row indices
+        t = t.index_select(0, rj)  # (label个数x3,7) 附近的2个网格anchor，都算该gt的anchor点
+        # 下面这句代码也是同样情况, 依据j矩阵中为True的方向, 将对应的偏移选出来放在offsets中, 后续gxy-offsets表示
+        offsets = off.index_select(0, dj)
+        n = torch.bincount(lj, minlength=nl).tolist()  # 每层的正样本数
+    else:
+        t = targets[0]
+        offsets = 0
+        n = [0] * nl
+
+    # 按照yolov3，则直接（gxy-0.5）.long()即可得到网格坐标
+    # 但是这里考虑了附近网格，故offsets不再是0.5而是2个邻居
+    # 所以xy回归范围也变了，不再是0-1，而是0-2
+    # 宽高范围也不一样了，而是0-4，因为超过4倍比例是算不匹配anchor，所以最大是4
+    b, c = t[:, :2].long().T  # image_index, class
+    gxy = t[:, 2:4]  # grid xy
+    gwh = t[:, 4:6]  # grid wh
+    # 根据offsets将gxy进行对应的平移操作后进行取整, 就得到每个gt所属的格子位置.
+    gij = (gxy - offsets).long()
+    # gi,gj主要是根据gt所在位置, 找出这个格子对应的anchor, 也就是说,(gj, gi)网格
+    # 中的anchor也将去负责预测这个gt, 但是值得注意的是(gj, gi)中的anchor负责预测的
+    # gt不是gxy-offsets, 而是gxy.这千万不要混淆. gxy-offsets只是为了定位旁边格子
+    # 的位置, 从而找到cell(gj, gi)中的anchor, 换句话说, 也就是cell(gj,gi)中的anchor
+    # 预测cell(gj+1, gi)中的gt.
+    gi, gj = gij.T
+
+    # t[:, 6]表示的是gt对应的anchor信息, 如果gt_1在网格(1,2)中是由anchor_2负责,
+    # 则在cell(1,3)同样由anchor_2负责.
+    a = t[:, 6].long()
+    # tbox中的gxy-gij也即每个网格对应的xy target回归量
+    tb, tt = torch.cat((gxy - gij, gwh), 1), torch.cat((gxy, gwh), 1)
+
+    # 最后才按层拆成list, 保持compute_loss的接口不变
+    for i, (bi, ai, gji, gii, tbi, tti, ci) in enumerate(zip(*(x.split(n) for x in (b, a, gj, gi, tb, tt, c)))):
+        indices.append((bi, ai, gji, gii))  # (image, anchor, grid indices)
+        tbox.append(tbi)  # ((x-x_i),(y-y_i),w,h)
+        ttar.append(tti)  # (x,y,w,h)
+        anch.append(det.anchors[i][ai])  # anchors
+        tcls.append(ci)  # class
 
     return tcls, tbox, indices, anch, ttar
 
 
+# YOLO_COMPILE_LOSS=1 (or a torch.compile mode, e.g. reduce-overhead for CUDA graphs) compiles compute_loss, torch>=2.0
+_COMPILE_LOSS = os.environ.get('YOLO_COMPILE_LOSS', '0')
+if _COMPILE_LOSS != '0' and hasattr(torch, 'compile'):
+    build_targets = torch._dynamo.disable(build_targets)  # data-dependent target counts, runs eagerly between graphs
+    compute_loss = torch.compile(compute_loss, mode=None if _COMPILE_LOSS == '1' else _COMPILE_LOSS)
+
+
 def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False):
     """Performs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
-    if prediction.dtype is torch.float16:
-        prediction = prediction.float()  # to FP32
-
     nc = prediction[0].shape[1] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
@@ -938,51 +1093,59 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
+    classes_t = torch.as_tensor(classes, device=prediction.device) if classes else None  # classes filter
 
     t = time.time()
-    output = [None] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
+    bs = prediction.shape[0]  # batch size
+    output = [None] * bs
+    # 整个batch的候选框展平后一起处理, bi记录每个候选框属于第几张图片(按图片顺序排列)
+    bi, ai = xc.nonzero(as_tuple=False).T  # image index, anchor index
+    x = prediction[bi, ai].float()  # confidence, only the candidates are upcast to FP32
+    # Apply constraints
+    # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
+
+    # If none remain return
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), bi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float()), 1)[i], bi[i]
+
+    # Filter by class
+    if classes:
+        i = (x[:, 5:6] == classes_t).any(1)
+        x, bi = x[i], bi[i]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     x = x[torch.isfinite(x).all(1)]
+
+    # If none remain return
+    if not x.shape[0]:
+        return output
+
+    # 候选框的筛选和打分已对整个batch一次完成, NMS仍然按图片逐张做, 类别偏移和原来一样限制在max_wh * nc以内
+    counts = torch.bincount(bi, minlength=bs).tolist()  # number of boxes per image
+    for xi, (xb, n) in enumerate(zip(x.split(counts), counts)):  # image index, image detections
         # If none remain process next image
-        n = x.shape[0]  # number of boxes
         if not n:
             continue
 
-        # Sort by confidence
-        # x = x[x[:, 4].argsort(descending=True)]
-
         # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+        c = xb[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        boxes, scores = xb[:, :4] + c, xb[:, 4]  # boxes (offset by class), scores
         i = torchvision.ops.boxes.nms(boxes, scores, iou_thres)
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
@@ -990,14 +1153,14 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
             try:  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
                 iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
                 weights = iou * scores[None]  # box weights
-                x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+                xb[i, :4] = torch.mm(weights, xb[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
                 if redundant:
                     i = i[iou.sum(1) > 1]  # require redundancy
             except:  # possible CUDA error https://github.com/ultralytics/yolov3/issues/1139
-                print(x, i, x.shape, i.shape)
+                print(xb, i, xb.shape, i.shape)
                 pass
 
-        output[xi] = x[i]
+        output[xi] = xb[i]
         if (time.time() - t) > time_limit:
             break  # time limit exceeded
 
@@ -1018,22 +1181,36 @@ def strip_optimizer(f='weights/best.pt', s=''):  # from utils.utils import *; st
     print('Optimizer stripped from %s,%s %.1fMB' % (f, (' saved as %s,' % s) if s else '', mb))
 
 
+def _dir_files(path):
+    # Returns the '*.*' file paths in directory path, one scandir pass without per-file stat on most filesystems
+    return [e.path for e in os.scandir(path) if '.' in e.name and not e.name.startswith('.') and e.is_file()]
+
+
+def _read_label_file(file):
+    # Returns the nx5 labels of one *.txt file (empty files give 0x5)
+    with open(file, 'r') as f:
+        return np.array(f.read().split(), dtype=np.float32).reshape(-1, 5)
+
+
+def read_labels(files, workers=16):
+    # Reads many small label files in parallel threads, the scan is I/O bound so the GIL is released while waiting
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(_read_label_file, files))
+
+
 def coco_class_count(path='../coco/labels/train2014/'):
     # Histogram of occurrences per class
     nc = 80  # number classes
-    x = np.zeros(nc, dtype='int32')
-    files = sorted(glob.glob('%s/*.*' % path))
-    for i, file in enumerate(files):
-        labels = np.loadtxt(file, dtype=np.float32).reshape(-1, 5)
-        x += np.bincount(labels[:, 0].astype('int32'), minlength=nc)
-        print(i, len(files))
+    labels = read_labels(_dir_files(path))  # order does not matter for counting
+    x = np.bincount(np.concatenate([l[:, 0] for l in labels] + [np.zeros(0)]).astype('int32'), minlength=nc)
+    print(x)
+    return x
 
 
 def coco_only_people(path='../coco/labels/train2017/'):  # from utils.utils import *; coco_only_people()
     # Find images with only people
-    files = sorted(glob.glob('%s/*.*' % path))
-    for i, file in enumerate(files):
-        labels = np.loadtxt(file, dtype=np.float32).reshape(-1, 5)
+    files = sorted(_dir_files(path))
+    for file, labels in zip(files, read_labels(files)):
         if all(labels[:, 0] == 0):
             print(labels.shape[0], file)
 
@@ -1041,7 +1218,7 @@ def coco_only_people(path='../coco/labels/train2017/'):  # from utils.utils impo
 def crop_images_random(path='../images/', scale=0.50):  # from utils.utils import *; crop_images_random()
     # crops images into random squares up to scale fraction
     # WARNING: overwrites images!
-    for file in tqdm(sorted(glob.glob('%s/*.*' % path))):
+    for file in tqdm(_dir_files(path)):
         img = cv2.imread(file)  # BGR
         if img is not None:
             h, w = img.shape[:2]
@@ -1068,9 +1245,8 @@ def coco_single_class_labels(path='../coco/labels/train2014/', label_class=43):
     os.makedirs('new/')  # make new output folder
     os.makedirs('new/labels/')
     os.makedirs('new/images/')
-    for file in tqdm(sorted(glob.glob('%s/*.*' % path))):
-        with open(file, 'r') as f:
-            labels = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
+    files = sorted(_dir_files(path))  # sorted, new/images.txt is written in this order
+    for file, labels in tqdm(zip(files, read_labels(files)), total=len(files)):
         i = labels[:, 0] == label_class
         if any(i):
             img_file = file.replace('labels', 'images').replace('txt', 'jpg')
@@ -1083,6 +1259,47 @@ def coco_single_class_labels(path='../coco/labels/train2014/', label_class=43):
             shutil.copyfile(src=img_file, dst='new/images/' + Path(file).name.replace('txt', 'jpg'))  # copy images
 
 
+def _kmeans_iou_np(wh, k, iters=30):
+    # k-means on nx2 wh points with 1 - IoU distance (k is the initial mx2 centroids, updated in place)
+    for _ in range(iters):
+        inter = np.minimum(wh[:, None], k[None]).prod(2)  # nxm
+        a = (inter / (wh.prod(1)[:, None] + k.prod(1)[None] - inter)).argmax(1)  # nearest centroid = max IoU
+        c = np.bincount(a, minlength=len(k))  # points per cluster
+        i = c > 0  # leave empty clusters in place
+        k[i, 0] = np.bincount(a, weights=wh[:, 0], minlength=len(k))[i] / c[i]
+        k[i, 1] = np.bincount(a, weights=wh[:, 1], minlength=len(k))[i] / c[i]
+    return k
+
+
+def _kmeans_iou_nb(wh, k, iters=30):
+    # numba kernel of _kmeans_iou_np(), parallel over points
+    n, m = wh.shape[0], k.shape[0]
+    a = np.zeros(n, np.int64)
+    for _ in range(iters):
+        for i in prange(n):
+            best, bj = -1.0, 0
+            for j in range(m):
+                inter = min(wh[i, 0], k[j, 0]) * min(wh[i, 1], k[j, 1])
+                iou = inter / (wh[i, 0] * wh[i, 1] + k[j, 0] * k[j, 1] - inter)
+                if iou > best:
+                    best, bj = iou, j
+            a[i] = bj
+        s = np.zeros((m, 2), np.float64)
+        c = np.zeros(m, np.int64)
+        for i in range(n):
+            s[a[i], 0] += wh[i, 0]
+            s[a[i], 1] += wh[i, 1]
+            c[a[i]] += 1
+        for j in range(m):
+            if c[j]:
+                k[j, 0] = s[j, 0] / c[j]
+                k[j, 1] = s[j, 1] / c[j]
+    return k
+
+
+_kmeans_iou = njit(parallel=True, fastmath=True)(_kmeans_iou_nb) if njit else _kmeans_iou_np
+
+
 def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True):
     """ Creates kmeans-evolved anchors from training dataset
 
@@ -1091,7 +1308,7 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
             n: number of anchors
             img_size: image size used for training
             thr: anchor-label wh ratio threshold hyperparameter hyp['anchor_t'] used for training, default=4.0
-            gen: generations to evolve anchors using genetic algorithm
+            gen: generations to evolve anchors using genetic algorithm, each evaluating a batch of mutations
 
         Return:
             k: kmeans evolved anchors
@@ -1107,9 +1324,10 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
         # x = wh_iou(wh, torch.tensor(k))  # iou metric
         return x, x.max(1)[0]  # x, best_x
 
-    def fitness(k):  # mutation fitness
-        _, best = metric(torch.tensor(k, dtype=torch.float32), wh)
-        return (best * (best > thr).float()).mean()  # fitness
+    def fitness(k):  # mutation fitness of a gxnx2 batch of anchor sets
+        r = wh[None, :, None] / torch.tensor(k, dtype=torch.float32)[:, None]  # g x points x n x 2
+        best = torch.min(r, 1. / r).min(3)[0].max(2)[0]  # best ratio metric, g x points
+        return (best * (best > thr).float()).mean(1)  # fitness
 
     def print_results(k):
         k = k[np.argsort(k.prod(1))]  # sort small to large
@@ -1124,7 +1342,7 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
 
     if isinstance(path, str):  # *.yaml file
         with open(path) as f:
-            data_dict = yaml.load(f, Loader=yaml.FullLoader)  # model dict
+            data_dict = yaml.load(f, Loader=SafeLoader)  # model dict
         from utils.datasets import LoadImagesAndLabels
         dataset = LoadImagesAndLabels(data_dict['train'], augment=True, rect=True)
     else:
@@ -1141,11 +1359,11 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
               '%g of %g labels are < 3 pixels in width or height.' % (i, len(wh0)))
     wh = wh0[(wh0 >= 2.0).any(1)]  # filter > 2 pixels
 
-    # Kmeans calculation
+    # Kmeans calculation (1 - IoU distance)
     print('Running kmeans for %g anchors on %g points...' % (n, len(wh)))
-    s = wh.std(0)  # sigmas for whitening
-    k, dist = kmeans(wh / s, n, iter=30)  # points, mean distance
-    k *= s
+    wh = np.ascontiguousarray(wh, dtype=np.float32)
+    k = _kmeans_iou(wh, wh[np.random.choice(len(wh), n, replace=len(wh) < n)].copy(), 30)  # init from random points
+    k = k.astype(np.float64)
     wh = torch.tensor(wh, dtype=torch.float32)  # filtered
     wh0 = torch.tensor(wh0, dtype=torch.float32)  # unflitered
     k = print_results(k)
@@ -1165,17 +1383,20 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
 
     # Evolve
     npr = np.random
-    f, sh, mp, s = fitness(k), k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
+    f, sh, mp, s = fitness(k[None])[0], k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
+    bg = max(1, min(8, int(1E7 // (len(wh) * n))))  # mutations per generation, bounded by the g x points x n x 2 tensor
+    gs = (bg,) + sh  # batch shape
     pbar = tqdm(range(gen), desc='Evolving anchors with Genetic Algorithm')  # progress bar
     for _ in pbar:
-        v = np.ones(sh)
-        # 变异操作
-        while (v == 1).all():  # mutate until a change occurs (prevent duplicates)
-            v = ((npr.random(sh) < mp) * npr.random() * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
-        kg = (k.copy() * v).clip(min=2.0)
+        # 变异操作, 每一代对当前k生成一批变异并一起计算fitness, 最好的一个优于f时才接受
+        v = ((npr.random(gs) < mp) * npr.random((gs[0], 1, 1)) * npr.randn(*gs) * s + 1).clip(0.3, 3.0)
+        kg = (k * v[(v != 1).any((1, 2))]).clip(min=2.0)  # drop mutations without change (prevent duplicates)
+        if not len(kg):
+            continue
         fg = fitness(kg)
-        if fg > f:
-            f, k = fg, kg.copy()
+        i = int(fg.argmax())
+        if fg[i] > f:
+            f, k = fg[i], kg[i].copy()
             pbar.desc = 'Evolving anchors with Genetic Algorithm: fitness = %.4f' % f
             if verbose:
                 print_results(k)
@@ -1183,6 +1404,24 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
     return print_results(k)
 
 
+_EVOLVE_CACHE = {}  # evolve.txt path: (file stat, rows), kept by print_mutation()
+
+
+def _file_stat(file):
+    st = os.stat(file)
+    return st.st_mtime_ns, st.st_size
+
+
+def _evolve_rows(file):
+    # Returns the rows of evolve.txt, re-read only if the file changed since print_mutation() last wrote it
+    if not os.path.exists(file):
+        return None
+    stat, x = _EVOLVE_CACHE.get(os.path.abspath(file), (None, None))
+    if stat != _file_stat(file):
+        x = np.loadtxt(file, ndmin=2)
+    return x
+
+
 def print_mutation(hyp, results, yaml_file='hyp_evolved.yaml', bucket=''):
     # Print mutation results to evolve.txt (for use with train.py --evolve)
     a = '%10s' * len(hyp) % tuple(hyp.keys())  # hyperparam keys
@@ -1193,11 +1432,18 @@ def print_mutation(hyp, results, yaml_file='hyp_evolved.yaml', bucket=''):
     if bucket:
         os.system('gsutil cp gs://%s/evolve.txt .' % bucket)  # download evolve.txt
 
-    with open('evolve.txt', 'a') as f:  # append result
-        f.write(c + b + '\n')
-    x = np.unique(np.loadtxt('evolve.txt', ndmin=2), axis=0)  # load unique rows
+    # evolve.txt只在第一次(或被其它进程/gsutil改动后)读取, 之后直接在内存中追加新行
+    x = _evolve_rows('evolve.txt')
+    row = np.array((c + b).split(), dtype=np.float64)  # results在排序和写yaml之前保持%10.4g精度
+    x = row[None] if x is None else np.concatenate((x, row[None]))
+    x = np.unique(x, axis=0)  # unique rows
     x = x[np.argsort(-fitness(x))]  # sort
-    np.savetxt('evolve.txt', x, '%10.3g')  # save sort by fitness
+    fmt = ' '.join(['%10.3g'] * x.shape[1]) + '\n'
+    s = ''.join(fmt % tuple(r) for r in x)
+    with open('evolve.txt', 'w') as f:  # save sort by fitness
+        f.write(s)
+    saved = np.array(s.split(), dtype=np.float64).reshape(x.shape)  # rows as saved, i.e. as np.loadtxt would read them
+    _EVOLVE_CACHE[os.path.abspath('evolve.txt')] = _file_stat('evolve.txt'), saved
 
     if bucket:
         os.system('gsutil cp evolve.txt gs://%s' % bucket)  # upload evolve.txt
@@ -1230,18 +1476,14 @@ def apply_classifier(x, model, img, im0):
 
             # Classes
             pred_cls1 = d[:, 5].long()
-            ims = []
-            for j, a in enumerate(d):  # per item
-                cutout = im0[i][int(a[1]):int(a[3]), int(a[0]):int(a[2])]
-                im = cv2.resize(cutout, (224, 224))  # BGR
-                # cv2.imwrite('test%i.jpg' % j, cutout)
-
-                im = im[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-                im = np.ascontiguousarray(im, dtype=np.float32)  # uint8 to float32
-                im /= 255.0  # 0 - 255 to 0.0 - 1.0
-                ims.append(im)
-
-            pred_cls2 = model(torch.Tensor(ims).to(d.device)).argmax(1)  # classifier prediction
+            # 所有cutout一次roi_align完成裁剪和resize, 不再逐个检测框cv2.resize
+            # 注意: 大框缩小时roi_align对每个输出像素取多点平均, cv2 INTER_LINEAR不会, 分类器输入数值与原来不同
+            im = torch.from_numpy(im0[i]).to(d.device).permute(2, 0, 1)[None].float()  # BGR 1x3xhxw
+            rois = torch.cat((torch.zeros_like(d[:, :1]), d[:, :4].floor()), 1).float()  # (batch index, xyxy)
+            ims = torchvision.ops.roi_align(im, rois, (224, 224), aligned=True)  # nx3x224x224
+            ims = ims[:, [2, 1, 0]] / 255.0  # BGR to RGB, 0 - 255 to 0.0 - 1.0
+
+            pred_cls2 = model(ims).argmax(1)  # classifier prediction
             x[i] = x[i][pred_cls1 == pred_cls2]  # retain matching class detections
 
     return x
@@ -1258,21 +1500,13 @@ def output_to_target(output, width, height):
     if isinstance(output, torch.Tensor):
         output = output.cpu().numpy()
 
-    targets = []
-    for i, o in enumerate(output):
-        if o is not None:
-            for pred in o:
-                box = pred[:4]
-                w = (box[2] - box[0]) / width
-                h = (box[3] - box[1]) / height
-                x = box[0] / width + w / 2
-                y = box[1] / height + h / 2
-                conf = pred[4]
-                cls = int(pred[5])
-
-                targets.append([i, cls, x, y, w, h, conf])
-
-    return np.array(targets)
+    # 所有图片的检测结果拼成一个nx6矩阵后一次性转换, 不再逐个检测框循环
+    o = [x.cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for x in output if x is not None]
+    i = np.concatenate([np.full(len(x), bi) for bi, x in enumerate(output) if x is not None] + [np.zeros(0)])  # batch_id
+    o = np.concatenate(o + [np.zeros((0, 6))]).astype(np.float64)
+    box = o[:, :4] / np.array([width, height, width, height])
+    wh = box[:, 2:] - box[:, :2]
+    return np.concatenate((i[:, None], o[:, 5:6].astype(int), box[:, :2] + wh / 2, wh, o[:, 4:5]), 1)
 
 
 def increment_dir(dir, comment=''):
@@ -1286,25 +1520,100 @@ def increment_dir(dir, comment=''):
 
 
 # Plotting functions ---------------------------------------------------------------------------------------------------
-def hist2d(x, y, n=100):
-    # 2d histogram used in labels.png and evolve.png
-    xedges, yedges = np.linspace(x.min(), x.max(), n), np.linspace(y.min(), y.max(), n)
-    hist, xedges, yedges = np.histogram2d(x, y, (xedges, yedges))
-    xidx = np.clip(np.digitize(x, xedges) - 1, 0, hist.shape[0] - 1)
-    yidx = np.clip(np.digitize(y, yedges) - 1, 0, hist.shape[1] - 1)
-    return np.log(hist[xidx, yidx])
+PLOT_DPI = int(os.environ.get('YOLO_PLOT_DPI', 100))  # savefig() dpi, e.g. YOLO_PLOT_DPI=200 for hi-res plots
+PNG_KWARGS = {'compress_level': 1}  # savefig() Pillow PNG options, fast zlib level for throwaway training plots
+
+
+def _parse_columns(f, usecols, dtype):
+    # Parses columns usecols (None for all) of whitespace-delimited text file f, pandas C parser if available
+    if pd is None:
+        if usecols is None and os.path.isfile(f):  # 全部列 (如evolve.txt): 整个文件交给numpy的C解析器, 不逐行解析
+            with open(f, 'rb') as fh:
+                buf = fh.read().strip()
+            n = buf.count(b'\n') + 1 if buf else 0  # number of rows
+            nc = len(buf.split(b'\n', 1)[0].split())  # number of columns
+            x = np.fromstring(buf.decode(), dtype=dtype, sep=' ')
+            if n and x.size == n * nc and len(buf.rsplit(b'\n', 1)[-1].split()) == nc:  # rows of equal width
+                return x.reshape(n, nc)
+        return np.loadtxt(f, dtype=dtype, usecols=usecols, ndmin=2)
+    try:
+        x = pd.read_csv(f, sep=r'\s+', header=None, usecols=usecols, dtype=dtype, engine='c')
+    except pd.errors.EmptyDataError:
+        return np.zeros((0, len(usecols) if usecols else 0), dtype=dtype)
+    return (x if usecols is None else x[usecols]).to_numpy()
+
+
+def load_columns(f, usecols=None, dtype=np.float32):
+    # Returns columns usecols (None for all) of text file f as an nxm array
+    # 解析结果缓存在同目录的f.npz中, 只要f没有改变(大小和修改时间)就直接读取缓存, 不再重新解析文本
+    cache, key = None, None
+    if os.path.isfile(f):
+        st = os.stat(f)
+        key = np.array(list(usecols or []) + [st.st_size, st.st_mtime], dtype=np.float64)
+        cache = str(f) + '.npz'
+        try:
+            with np.load(cache) as c:
+                if np.array_equal(c['key'], key) and c['x'].dtype == dtype:
+                    return c['x']
+        except (OSError, KeyError, ValueError):  # no cache yet or unreadable
+            pass
+    x = _parse_columns(f, usecols, dtype)
+    if cache:
+        try:
+            np.savez(cache, x=x, key=key)
+        except OSError:  # read-only directory
+            pass
+    return x
+
+
+def _load_results(f):
+    # Returns the plot_results() rows of results file f as a 10xn array, None if it is empty or can not be read
+    if os.path.isfile(f) and os.path.getsize(f) < 64:  # 中断的训练可能只留下空文件, 一行结果都没有
+        print('Warning: Plotting skipped empty %s' % f)
+        return None
+    try:
+        return load_columns(f, [2, 3, 4, 8, 9, 12, 13, 14, 10, 11]).T
+    except (OSError, ValueError):  # e.g. bucket URL without pandas, failed download, malformed file
+        print('Warning: Plotting error for %s, skipping file' % f)
+
+
+def hist2d(x, y, n=100, bounds=None):
+    # 2d histogram used in labels.png and evolve.png, bounds=((xmin, xmax), (ymin, ymax)) if already known
+    # 等宽bin, 直接整数运算得到每个点的bin下标, 再用bincount统计, 不需要histogram2d和digitize的二分查找
+    def bin_index(v, r):
+        vmin, vmax = r or (v.min(), v.max())
+        dv = (vmax - vmin) / (n - 1) or 1.  # uniform bin width
+        return np.clip(((v - vmin) / dv).astype(np.int64), 0, n - 2)
+
+    rx, ry = bounds or (None, None)
+    i = bin_index(x, rx) * (n - 1) + bin_index(y, ry)  # linear bin index of every point
+    return np.log(np.bincount(i, minlength=(n - 1) ** 2)[i])
 
 
 def butter_lowpass_filtfilt(data, cutoff=1500, fs=50000, order=5):
     # https://stackoverflow.com/questions/28536191/how-to-filter-smooth-with-scipy-numpy
-    def butter_lowpass(cutoff, fs, order):
-        nyq = 0.5 * fs
-        normal_cutoff = cutoff / nyq
-        b, a = butter(order, normal_cutoff, btype='low', analog=False)
-        return b, a
+    return sosfiltfilt(_butter_lowpass(cutoff, fs, order), data)  # forward-backward filter
+
+
+@lru_cache(maxsize=8)
+def _butter_lowpass(cutoff, fs, order):
+    # Returns lowpass filter second-order sections, designed once per (cutoff, fs, order)
+    nyq = 0.5 * fs
+    normal_cutoff = cutoff / nyq
+    return butter(order, normal_cutoff, btype='low', analog=False, output='sos')
+
 
-    b, a = butter_lowpass(cutoff, fs, order=order)
-    return filtfilt(b, a, data)  # forward-backward filter
+@lru_cache(maxsize=2048)
+def _text_size(label, font_scale, thickness):
+    # Returns cv2.getTextSize() (w, h) of label, cached since the same class labels repeat on every image
+    return cv2.getTextSize(label, 0, fontScale=font_scale, thickness=thickness)[0]
+
+
+@lru_cache(maxsize=1024)
+def class_color(i):
+    # Returns a random but stable (b, g, r) colour for class index i, the same across calls and runs
+    r = random.Random(i)
+    return tuple(r.randint(0, 255) for _ in range(3))
 
 
 def plot_one_box(x, img, color=None, label=None, line_thickness=None):
@@ -1315,7 +1624,7 @@ def plot_one_box(x, img, color=None, label=None, line_thickness=None):
     cv2.rectangle(img, c1, c2, color, thickness=tl, lineType=cv2.LINE_AA)
     if label:
         tf = max(tl - 1, 1)  # font thickness
-        t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+        t_size = _text_size(label, tl / 3, tf)
         c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
         cv2.rectangle(img, c1, c2, color, -1, cv2.LINE_AA)  # filled
         cv2.putText(img, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
@@ -1339,7 +1648,14 @@ def plot_wh_methods():  # from utils.utils import *; plot_wh_methods()
     plt.grid()
     plt.legend()
     fig.tight_layout()
-    fig.savefig('comparison.png', dpi=200)
+    fig.savefig('comparison.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)
+
+
+# Fix class - colour map, nx3 RGB from the matplotlib colour cycle
+# https://stackoverflow.com/questions/51350872/python-from-color-name-to-rgb
+_COLOR_LUT = (np.array([matplotlib.colors.to_rgb(c) for c in plt.rcParams['axes.prop_cycle'].by_key()['color']])
+              * 255).round().astype(np.uint8)
 
 
 def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max_size=640, max_subplots=16):
@@ -1371,12 +1687,6 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
     # Empty array for output
     mosaic = np.full((int(ns * h), int(ns * w), 3), 255, dtype=np.uint8)
 
-    # Fix class - colour map
-    prop_cycle = plt.rcParams['axes.prop_cycle']
-    # https://stackoverflow.com/questions/51350872/python-from-color-name-to-rgb
-    hex2rgb = lambda h: tuple(int(h[1 + i:1 + i + 2], 16) for i in (0, 2, 4))
-    color_lut = [hex2rgb(h) for h in prop_cycle.by_key()['color']]
-
     for i, img in enumerate(images):
         if i == max_subplots:  # if last batch has fewer images than we expect
             break
@@ -1396,13 +1706,12 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
             gt = image_targets.shape[1] == 6  # ground truth if no conf column
             conf = None if gt else image_targets[:, 6]  # check for confidence presence (gt vs pred)
 
-            boxes[[0, 2]] *= w
-            boxes[[0, 2]] += block_x
-            boxes[[1, 3]] *= h
-            boxes[[1, 3]] += block_y
+            boxes *= np.array([[w], [h], [w], [h]])
+            boxes += np.array([[block_x], [block_y], [block_x], [block_y]])
+            colors = _COLOR_LUT[classes % len(_COLOR_LUT)].tolist()
             for j, box in enumerate(boxes.T):
                 cls = int(classes[j])
-                color = color_lut[cls % len(color_lut)]
+                color = colors[j]
                 cls = names[cls] if names else cls
                 if gt or conf[j] > 0.3:  # 0.3 conf thresh
                     label = '%s' % cls if gt else '%s %.1f' % (cls, conf[j])
@@ -1411,7 +1720,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
         # Draw image filename labels
         if paths is not None:
             label = os.path.basename(paths[i])[:40]  # trim to 40 char
-            t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+            t_size = _text_size(label, tl / 3, tf)
             cv2.putText(mosaic, label, (block_x + 5, block_y + t_size[1] + 5), 0, tl / 3, [220, 220, 220], thickness=tf,
                         lineType=cv2.LINE_AA)
 
@@ -1439,7 +1748,8 @@ def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     plt.xlim(0, epochs)
     plt.ylim(0)
     plt.tight_layout()
-    plt.savefig(Path(save_dir) / 'LR.png', dpi=200)
+    plt.savefig(Path(save_dir) / 'LR.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close()
 
 
 def plot_test_txt():  # from utils.utils import *; plot_test()
@@ -1451,12 +1761,14 @@ def plot_test_txt():  # from utils.utils import *; plot_test()
     fig, ax = plt.subplots(1, 1, figsize=(6, 6), tight_layout=True)
     ax.hist2d(cx, cy, bins=600, cmax=10, cmin=0)
     ax.set_aspect('equal')
-    plt.savefig('hist2d.png', dpi=300)
+    plt.savefig('hist2d.png', dpi=PLOT_DPI * 3 // 2, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)
 
     fig, ax = plt.subplots(1, 2, figsize=(12, 6), tight_layout=True)
     ax[0].hist(cx, bins=600)
     ax[1].hist(cy, bins=600)
-    plt.savefig('hist1d.png', dpi=200)
+    plt.savefig('hist1d.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)
 
 
 def plot_targets_txt():  # from utils.utils import *; plot_targets_txt()
@@ -1469,7 +1781,15 @@ def plot_targets_txt():  # from utils.utils import *; plot_targets_txt()
         ax[i].hist(x[i], bins=100, label='%.3g +/- %.3g' % (x[i].mean(), x[i].std()))
         ax[i].legend()
         ax[i].set_title(s[i])
-    plt.savefig('targets.jpg', dpi=200)
+    plt.savefig('targets.jpg', dpi=PLOT_DPI)
+    plt.close(fig)
+
+
+_STUDY_LEGEND_MAP = {'study_coco_': '', 'yolo': 'YOLO'}  # plot_study_txt() legend renames
+_STUDY_LEGEND = re.compile('|'.join(_STUDY_LEGEND_MAP))
+_EFFDET_MS = np.array([209., 140., 97., 58., 35., 18.], dtype=np.float32)  # EfficientDet D0-D5 speed (ms/img)
+_EFFDET_SPEED = 1E3 / _EFFDET_MS
+_EFFDET_AP = np.array([33.8, 39.6, 43.0, 47.5, 49.4, 50.7], dtype=np.float32)  # EfficientDet D0-D5 COCO AP
 
 
 def plot_study_txt(f='study.txt', x=None):  # from utils.utils import *; plot_study_txt()
@@ -1478,19 +1798,26 @@ def plot_study_txt(f='study.txt', x=None):  # from utils.utils import *; plot_st
     ax = ax.ravel()
 
     fig2, ax2 = plt.subplots(1, 1, figsize=(8, 4), tight_layout=True)
-    for f in ['coco_study/study_coco_yolov5%s.txt' % x for x in ['s', 'm', 'l', 'x']]:
-        y = np.loadtxt(f, dtype=np.float32, usecols=[0, 1, 2, 3, 7, 8, 9], ndmin=2).T
-        x = np.arange(y.shape[1]) if x is None else np.array(x)
-        s = ['P', 'R', 'mAP@.5', 'mAP@.5:.95', 't_inference (ms/img)', 't_NMS (ms/img)', 't_total (ms/img)']
-        for i in range(7):
-            ax[i].plot(x, y[i], '.-', linewidth=2, markersize=8)
-            ax[i].set_title(s[i])
-
-        j = y[3].argmax() + 1
-        ax2.plot(y[6, :j], y[3, :j] * 1E2, '.-', linewidth=2, markersize=8,
-                 label=Path(f).stem.replace('study_coco_', '').replace('yolo', 'YOLO'))
-
-    ax2.plot(1E3 / np.array([209, 140, 97, 58, 35, 18]), [33.8, 39.6, 43.0, 47.5, 49.4, 50.7],
+    xy = []  # (x, y) of every study file
+    files = ['coco_study/study_coco_yolov5%s.txt' % x for x in ['s', 'm', 'l', 'x']]
+    ys = [load_columns(f, [0, 1, 2, 3, 7, 8, 9]) for f in files]  # (n, 7), 按列取值不转置
+    js = [y[:, 3].argmax() + 1 for y in ys]  # rows up to best mAP@.5:.95
+    # 所有文件的mAP * 100一次性分配, 每条曲线用互不重叠的一段 (Line2D只保存引用, 不能复用同一段)
+    buf = np.split(np.empty(sum(js), dtype=np.float32), np.cumsum(js)[:-1])
+    for f, y, j, b in zip(files, ys, js, buf):
+        x = np.arange(y.shape[0]) if x is None else np.array(x)
+        xy.append((x, y))
+
+        ax2.plot(y[:j, 6], np.multiply(y[:j, 3], 100, out=b), '.-', linewidth=2, markersize=8,
+                 label=_STUDY_LEGEND.sub(lambda m: _STUDY_LEGEND_MAP[m.group()], Path(f).stem))
+
+    # 每个子图只调用一次plot, 一次画出所有文件的曲线
+    s = ['P', 'R', 'mAP@.5', 'mAP@.5:.95', 't_inference (ms/img)', 't_NMS (ms/img)', 't_total (ms/img)']
+    for i in range(7):
+        ax[i].plot(*[a for x, y in xy for a in (x, y[:, i])], marker='.', linestyle='-', linewidth=2, markersize=8)
+        ax[i].set_title(s[i])
+
+    ax2.plot(_EFFDET_SPEED, _EFFDET_AP,
              'k.-', linewidth=2, markersize=8, alpha=.25, label='EfficientDet')
 
     ax2.grid()
@@ -1500,8 +1827,10 @@ def plot_study_txt(f='study.txt', x=None):  # from utils.utils import *; plot_st
     ax2.set_xlabel('GPU Speed (ms/img)')
     ax2.set_ylabel('COCO AP val')
     ax2.legend(loc='lower right')
-    plt.savefig('study_mAP_latency.png', dpi=300)
-    plt.savefig(f.replace('.txt', '.png'), dpi=200)
+    plt.savefig('study_mAP_latency.png', dpi=PLOT_DPI * 3 // 2, pil_kwargs=PNG_KWARGS)
+    plt.savefig(f.replace('.txt', '.png'), dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)
+    plt.close(fig2)
 
 
 def plot_labels(labels, save_dir=''):
@@ -1519,44 +1848,56 @@ def plot_labels(labels, save_dir=''):
     ax[2].scatter(b[2], b[3], c=hist2d(b[2], b[3], 90), cmap='jet')
     ax[2].set_xlabel('width')
     ax[2].set_ylabel('height')
-    plt.savefig(Path(save_dir) / 'labels.png', dpi=200)
+    plt.savefig(Path(save_dir) / 'labels.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
     plt.close()
 
 
 def plot_evolution(yaml_file='runs/evolve/hyp_evolved.yaml'):  # from utils.utils import *; plot_evolution()
     # Plot hyperparameter evolution results in evolve.txt
     with open(yaml_file) as f:
-        hyp = yaml.load(f, Loader=yaml.FullLoader)
-    x = np.loadtxt('evolve.txt', ndmin=2)
+        hyp = yaml.load(f, Loader=SafeLoader)
+    x = load_columns('evolve.txt', dtype=np.float64)
     f = fitness(x)
+    best, fmax = int(f.argmax()), f.max()  # 所有子图共用
+    f_range = (f.min(), fmax)
     # weights = (f - f.min()) ** 2  # for weighted results
     plt.figure(figsize=(10, 10), tight_layout=True)
     matplotlib.rc('font', **{'size': 8})
     for i, (k, v) in enumerate(hyp.items()):
         y = x[:, i + 7]
         # mu = (y * weights).sum() / weights.sum()  # best weighted result
-        mu = y[f.argmax()]  # best single result
+        mu = y[best]  # best single result
         plt.subplot(5, 5, i + 1)
-        plt.scatter(y, f, c=hist2d(y, f, 20), cmap='viridis', alpha=.8, edgecolors='none')
-        plt.plot(mu, f.max(), 'k+', markersize=15)
+        plt.scatter(y, f, c=hist2d(y, f, 20, bounds=((y.min(), y.max()), f_range)), cmap='viridis', alpha=.8,
+                    edgecolors='none')
+        plt.plot(mu, fmax, 'k+', markersize=15)
         plt.title('%s = %.3g' % (k, mu), fontdict={'size': 9})  # limit to 40 characters
         if i % 5 != 0:
             plt.yticks([])
         print('%15s: %.3g' % (k, mu))
-    plt.savefig('evolve.png', dpi=200)
+    plt.savefig('evolve.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close()
     print('\nPlot saved as evolve.png')
 
 
+def _results_files(*dirs):
+    # Returns the 'results*.txt' paths in dirs ('' for the working directory), one scandir pass per directory
+    return [os.path.join(d, e.name) for d in dirs if os.path.isdir(d or '.') for e in os.scandir(d or '.')
+            if e.name.startswith('results') and e.name.endswith('.txt') and e.is_file()]
+
+
 def plot_results_overlay(start=0, stop=0):  # from utils.utils import *; plot_results_overlay()
     # Plot training 'results*.txt', overlaying train and val losses
     s = ['train', 'train', 'train', 'Precision', 'mAP@0.5', 'val', 'val', 'val', 'Recall', 'mAP@0.5:0.95']  # legends
     t = ['GIoU', 'Objectness', 'Classification', 'P-R', 'mAP-F1']  # titles
-    for f in sorted(glob.glob('results*.txt') + glob.glob('../../Downloads/results*.txt')):
-        results = np.loadtxt(f, usecols=[2, 3, 4, 8, 9, 12, 13, 14, 10, 11], ndmin=2).T
+    fig, ax = plt.subplots(1, 5, figsize=(14, 3.5), tight_layout=True)  # 所有文件共用一个figure, 每次只清空子图
+    ax = ax.ravel()
+    for f in sorted(_results_files('', '../../Downloads')):
+        results = load_columns(f, [2, 3, 4, 8, 9, 12, 13, 14, 10, 11]).T
         n = results.shape[1]  # number of rows
         x = range(start, min(stop, n) if stop else n)
-        fig, ax = plt.subplots(1, 5, figsize=(14, 3.5), tight_layout=True)
-        ax = ax.ravel()
+        for a in ax:
+            a.clear()
         for i in range(5):
             for j in [i, i + 5]:
                 y = results[j, x]
@@ -1567,7 +1908,8 @@ def plot_results_overlay(start=0, stop=0):  # from utils.utils import *; plot_re
             ax[i].set_title(t[i])
             ax[i].legend()
             ax[i].set_ylabel(f) if i == 0 else None  # add filename
-        fig.savefig(f.replace('.txt', '.png'), dpi=200)
+        fig.savefig(f.replace('.txt', '.png'), dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)
 
 
 def plot_results(start=0, stop=0, bucket='', id=(), labels=(),
@@ -1581,25 +1923,34 @@ def plot_results(start=0, stop=0, bucket='', id=(), labels=(),
         os.system('rm -rf storage.googleapis.com')
         files = ['https://storage.googleapis.com/%s/results%g.txt' % (bucket, x) for x in id]
     else:
-        files = glob.glob(str(Path(save_dir) / 'results*.txt')) + glob.glob('../../Downloads/results*.txt')
-    for fi, f in enumerate(files):
-        try:
-            results = np.loadtxt(f, usecols=[2, 3, 4, 8, 9, 12, 13, 14, 10, 11], ndmin=2).T
+        files = _results_files(str(save_dir), '../../Downloads')
+
+    # 多线程并行读取和解析所有文件, 画图(非线程安全)仍在主线程中进行
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(files)))) as ex:
+        parsed = list(ex.map(_load_results, files))
+    data = []  # (x, results, label) of every readable file
+    loss = np.isin(np.arange(10), [0, 1, 2, 5, 6, 7])[:, None]  # loss rows
+    for fi, (f, results) in enumerate(zip(files, parsed)):
+        if results is not None:
             n = results.shape[1]  # number of rows
-            x = range(start, min(stop, n) if stop else n)
-            for i in range(10):
-                y = results[i, x]
-                if i in [0, 1, 2, 5, 6, 7]:
-                    y[y == 0] = np.nan  # dont show zero loss values
-                    # y /= y[0]  # normalize
-                label = labels[fi] if len(labels) else Path(f).stem
-                ax[i].plot(x, y, marker='.', label=label, linewidth=2, markersize=8)
-                ax[i].set_title(s[i])
-                # if i in [5, 6, 7]:  # share train and val loss y axes
-                #     ax[i].get_shared_y_axes().join(ax[i], ax[i - 5])
-        except:
-            print('Warning: Plotting error for %s, skipping file' % f)
+            stop_i = min(stop, n) if stop else n
+            x = np.arange(start, stop_i, max(1, math.ceil((stop_i - start) / 500)))  # at most 500 points per curve
+            results = results[:, x]
+            results[loss & (results == 0)] = np.nan  # dont show zero loss values, all loss rows at once (float32 nan)
+            data.append((x, results, labels[fi] if len(labels) else Path(f).stem))
+
+    # 每个子图只调用一次plot, 一次画出所有文件的曲线
+    for i in range(10):
+        xy = []
+        for x, results, _ in data:
+            xy += [x, results[i]]  # results[i] /= results[i, 0]  # normalize
+        for line, (_, _, label) in zip(ax[i].plot(*xy, marker='.', linewidth=2, markersize=8), data):
+            line.set_label(label)
+        ax[i].set_title(s[i])
+        # if i in [5, 6, 7]:  # share train and val loss y axes
+        #     ax[i].get_shared_y_axes().join(ax[i], ax[i - 5])
 
     fig.tight_layout()
     ax[1].legend()
-    fig.savefig(Path(save_dir) / 'results.png', dpi=200)
+    fig.savefig(Path(save_dir) / 'results.png', dpi=PLOT_DPI, pil_kwargs=PNG_KWARGS)
+    plt.close(fig)